@@ -7,14 +7,17 @@ allows you to drill down from cluster to namespace, to pods/deployments, and fro
 to individual containers, allowing you to inspect them and execute processes in
 their namespaces.
 """
+import functools
+import json
+import os
 import warnings
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import attr
-import yaml  # type: ignore
-from colorama import Fore, Style, init  # type: ignore
-from xdg import XDG_CONFIG_HOME  # type: ignore
+
+# yaml, colorama and xdg are imported where they're used, so that
+# importing k8sh (as every module here does) stays cheap.
 
 
 @attr.s
@@ -36,17 +39,74 @@ class ConfigProfiles:
         return self._profiles.get(profile, self.default)
 
 
+def _read_config(configfile: Path) -> Dict:
+    """Read the yaml configuration, using a json copy of it if it's up to date."""
+    cache = configfile.with_suffix(configfile.suffix + ".json")
+    stat = configfile.stat()
+    # A file restored with its old mtime can be older than the cache, so check both are the same.
+    source = [stat.st_size, stat.st_mtime_ns]
+    try:
+        cached = json.loads(cache.read_text())
+        if cached["source"] == source:
+            return cached["config"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    import yaml  # type: ignore
+
+    try:
+        # Use the libyaml-based loader if available, it's much faster.
+        from yaml import CSafeLoader as SafeLoader  # type: ignore
+    except ImportError:
+        from yaml import SafeLoader  # type: ignore
+
+    text = configfile.read_text()
+    # An empty file is an empty configuration, no need to parse it.
+    if not text.strip():
+        cfg: Dict = {}
+    else:
+        cfg = yaml.load(text, Loader=SafeLoader) or {}
+    try:
+        # Some things don't survive the trip through json (e.g. non-string keys become strings),
+        # and then the cache wouldn't give us back the same configuration.
+        if json.loads(json.dumps(cfg)) == cfg:
+            cache.write_text(json.dumps({"source": source, "config": cfg}))
+    except (OSError, TypeError, ValueError):
+        # Not being able to save the cache (or to represent the config in json) is no big deal.
+        pass
+    return cfg
+
+
+# The configurations already loaded, by path and modification time of the file.
+_setups: Dict[Tuple[Path, Optional[float]], ConfigProfiles] = {}
+
+
 def setup(configfile: Path) -> ConfigProfiles:
     """Load configfile. Setup execution"""
+    try:
+        mtime: Optional[float] = configfile.stat().st_mtime
+    except OSError:
+        mtime = None
+    # Only do the work again if the file has changed.
+    key = (configfile, mtime)
+    if key not in _setups:
+        _setups[key] = _setup(configfile)
+    return _setups[key]
+
+
+def _setup(configfile: Path) -> ConfigProfiles:
+    """Load configfile, uncached."""
+    from colorama import init  # type: ignore
+
     # Initialize colorama
     init()
-    cfg = {}
+    cfg: Dict = {}
     # Load a yaml config file, else just return the default configuration.
-    if configfile.exists():
-        try:
-            cfg = yaml.safe_load(configfile.read_text())
-        except Exception:
-            print(red("Bad configuration file, ignoring it."))
+    try:
+        cfg = _read_config(configfile)
+    except FileNotFoundError:
+        pass
+    except Exception:
+        print(red("Bad configuration file, ignoring it."))
     profiles = {}
     if "profiles" in cfg:
         for name, conf in cfg["profiles"].items():
@@ -56,25 +116,46 @@ def setup(configfile: Path) -> ConfigProfiles:
     return ConfigProfiles(Config(**cfg), profiles)
 
 
+# ANSI color codes, loaded on first use
+_RED = _BLUE = _RESET = ""
+
+
+def _load_colors():
+    global _RED, _BLUE, _RESET
+    from colorama import Fore, Style  # type: ignore
+
+    _RED = Style.BRIGHT + Fore.RED
+    _BLUE = Style.BRIGHT + Fore.BLUE
+    _RESET = Style.RESET_ALL
+
+
 def red(txt: str):
-    return Style.BRIGHT + Fore.RED + txt + Style.RESET_ALL
+    if not _RESET:
+        _load_colors()
+    return f"{_RED}{txt}{_RESET}"
 
 
 def blue(txt: str):
-    return Style.BRIGHT + Fore.BLUE + txt + Style.RESET_ALL
+    if not _RESET:
+        _load_colors()
+    return f"{_BLUE}{txt}{_RESET}"
 
 
 class k8shError(RuntimeError):
     """Special exception for logical errors."""
 
 
+@functools.lru_cache(maxsize=None)
 def k8shConfigPath() -> Path:
+    from xdg import XDG_CONFIG_HOME  # type: ignore
+
     filename = "k8shrc.yaml"
     xdgpath = XDG_CONFIG_HOME.joinpath(filename)
     legacypath = Path.home().joinpath(f".{filename}")
-    if xdgpath.is_file():
+    # access() is cheaper than the full stat() behind is_file()
+    if os.access(xdgpath, os.F_OK):
         return xdgpath
-    elif legacypath.is_file():
-        warnings.warn(f"Config path {legacypath} is deprecated, please use {xdgpath} instead")
+    elif os.access(legacypath, os.F_OK):
+        warnings.warn(f"Config path {legacypath} is deprecated, please use {xdgpath} instead", stacklevel=2)
         return legacypath
     return xdgpath
@@ -1,41 +1,110 @@
-import json
+import atexit
+import functools
+import os
+import re
+import selectors
 import shlex
 import subprocess
-from typing import List, Optional
+import threading
+import time
+from collections import OrderedDict
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import attr
 
 from k8sh import k8shError, red
 
+try:
+    # orjson is much faster on the large outputs of kubectl, use it if available.
+    from orjson import loads as json_loads  # type: ignore
+except ImportError:
+    from json import loads as json_loads  # type: ignore
 
-@attr.s
+
+@attr.s(slots=True, eq=False)
 class RemoteCommand:
     host: Optional[str] = attr.ib()
     ssh_opts: Optional[List[str]] = attr.ib(default=None)
     master_path: str = attr.ib(default="")
     _master: Optional[subprocess.Popen] = attr.ib(default=None)
+    # Size of the reads from the output of commands.
+    read_size = 65536
+    # The instances handed out by get()
+    _instances: Dict[Tuple[Optional[str], Tuple[str, ...], str], "RemoteCommand"] = {}
+
+    @classmethod
+    def get(cls, host: Optional[str], ssh_opts: Optional[List[str]] = None, master_path: str = "") -> "RemoteCommand":
+        """Get the instance for a host and options, creating it if needed.
+
+        This way all the users of a host share the same master connection.
+        """
+        key = (host, tuple(ssh_opts or ()), master_path)
+        if key not in cls._instances:
+            cls._instances[key] = cls(host, ssh_opts, master_path)
+        return cls._instances[key]
 
     def open(self):
         """Open a master connection if not already initiated."""
         if self.master_path == "":
             return
-        if self.host is None or self._master is not None:
+        if self.host is None:
             return
+        if self._master is not None:
+            if self._master_alive():
+                return
+            # The master went away (idle for too long, network drop...), start a new one.
+            self._master = None
+            atexit.unregister(self.close)
+        # ControlPersist makes the master go away on its own once idle, should we not get to close it.
         self._master = subprocess.Popen(
-            ["ssh", "-o", "ControlMaster=auto", "-o", f"ControlPath={self.master_path}", "-MN", self.host]
+            [
+                "ssh",
+                "-o",
+                "ControlMaster=auto",
+                "-o",
+                f"ControlPath={self.master_path}",
+                "-o",
+                "ControlPersist=60s",
+                "-MN",
+                self.host,
+            ]
         )
+        atexit.register(self.close)
+
+    def _master_alive(self) -> bool:
+        """Check if the master connection is still up."""
+        if self._master is None:
+            return False
+        if self._master.poll() is None:
+            return True
+        # With ControlPersist the master might have moved to the background, ask it.
+        check = subprocess.run(
+            ["ssh", "-o", f"ControlPath={self.master_path}", "-O", "check", str(self.host)],
+            capture_output=True,
+        )
+        return check.returncode == 0
+
+    def shares_master_path(self) -> bool:
+        """Whether the master path can be used for other hosts too, as ssh expands it per host."""
+        return any(token in self.master_path for token in ("%h", "%n", "%C"))
 
     def close(self):
         """Close a master connection if present."""
         if self._master is None:
             return
         self._master.terminate()
+        # With ControlPersist the master might have moved to the background, ask it to exit.
+        subprocess.run(
+            ["ssh", "-o", f"ControlPath={self.master_path}", "-O", "exit", self.host],
+            capture_output=True,
+        )
         self._master = None
+        atexit.unregister(self.close)
 
-    def _cmd(self, command: List[str]) -> List[str]:
-        if self.host is None:
-            return ["/bin/bash", "-c", shlex.join(command)]
-
+    def _ssh(self) -> List[str]:
+        """The ssh invocation to run commands on the remote host."""
+        # Funnel all our connections through the master, opening it on first use.
+        self.open()
         if self.ssh_opts is None:
             opts = []
         else:
@@ -43,51 +112,128 @@ class RemoteCommand:
         cmd = ["ssh", "-T"]
         if self._master is not None:
             cmd.extend(["-o", "ControlMaster=no", "-o", f"ControlPath={self.master_path}"])
-        cmd.append(self.host)
+        cmd.append(str(self.host))
 
-        return cmd + opts + command
+        return cmd + opts
+
+    def _cmd(self, command: List[str]) -> List[str]:
+        # Quote the command once, so that both bash and the remote shell get back the exact arguments.
+        return self._script_cmd(shlex.join(command))
+
+    def _script_cmd(self, script: str) -> List[str]:
+        if self.host is None:
+            return ["/bin/bash", "-c", script]
+        # The remote shell will interpret the script for us
+        return self._ssh() + [script]
 
     def run_sync(self, command: List[str]) -> int:
         """Runs a command on a remote host, and streams the output."""
         ssh = subprocess.Popen(self._cmd(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        rc = None
-        while rc is None:
-            try:
-                self._stdout(ssh)
-                self._stderr(ssh)
-                rc = ssh.poll()
-            except KeyboardInterrupt:
-                # Manage ctrl-c
-                ssh.terminate()
-                # We assume this is what the user intended, no reason to signal error.
-                rc = 0
-
-        if ssh.stdout is not None:
-            print(ssh.stdout.read().decode().rstrip())
-        if ssh.stderr is not None:
-            print(red(ssh.stderr.read().decode().rstrip()))
-        return rc
+        try:
+            self._stream(ssh)
+            return ssh.wait()
+        except KeyboardInterrupt:
+            # Manage ctrl-c
+            ssh.terminate()
+            # We assume this is what the user intended, no reason to signal error.
+            return 0
 
     def run(self, command: List[str]) -> subprocess.CompletedProcess:
         """Run a command via ssh."""
-        return subprocess.run(self._cmd(command), capture_output=True)
+        return self._capture(self._cmd(command))
 
-    def _stdout(self, proc: subprocess.Popen):
-        if proc.stdout is None:
-            return
-        out = proc.stdout.readline().decode().rstrip()
-        if out != "":
-            print(out)
+    def run_script(self, script: str) -> subprocess.CompletedProcess:
+        """Run a shell script via ssh."""
+        return self._capture(self._script_cmd(script))
 
-    def _stderr(self, proc: subprocess.Popen):
-        if proc.stderr is None:
-            return
-        out = proc.stderr.readline().decode().rstrip()
-        if out != "":
-            print(red(out))
+    def _capture(self, args: List[str]) -> subprocess.CompletedProcess:
+        """Run a process, collecting its output."""
+        with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+            output = {proc.stdout: bytearray(), proc.stderr: bytearray()}
+            try:
+                for pipe, chunk in self._read(proc):
+                    output[pipe] += chunk
+            except BaseException:
+                # Don't wait for the process on the way out, like subprocess.run
+                proc.kill()
+                raise
+            rc = proc.wait()
+        return subprocess.CompletedProcess(args, rc, bytes(output[proc.stdout]), bytes(output[proc.stderr]))
+
+    def _stream(self, proc: subprocess.Popen):
+        """Print the output of the process as it arrives."""
+        # The incomplete lines read so far
+        buffers = {proc.stdout: bytearray(), proc.stderr: bytearray()}
+        for pipe, chunk in self._read(proc):
+            color = pipe is proc.stderr
+            buf = buffers[pipe]
+            if chunk == b"":
+                # EOF, flush whatever is left.
+                if buf:
+                    self._print(buf, color)
+                continue
+            buf += chunk
+            # Print all the complete lines in one go, keep the rest for later.
+            end = buf.rfind(b"\n")
+            if end != -1:
+                self._print(buf[:end], color)
+                del buf[: end + 1]
+
+    def _read(self, proc: subprocess.Popen) -> Iterator[Tuple[IO[bytes], bytes]]:
+        """Read the output of the process on whichever stream is ready, until both are closed.
+
+        Yields the pipe and the data read from it, which is empty once the pipe is closed.
+        """
+        with selectors.DefaultSelector() as sel:
+            for pipe in [proc.stdout, proc.stderr]:
+                if pipe is None:
+                    continue
+                os.set_blocking(pipe.fileno(), False)
+                sel.register(pipe, selectors.EVENT_READ)
+            while sel.get_map():
+                for key, _ in sel.select():
+                    chunk = os.read(key.fd, self.read_size)
+                    if chunk == b"":
+                        sel.unregister(key.fileobj)
+                    yield key.fileobj, chunk  # type: ignore
+
+    def _print(self, block: bytearray, color: bool):
+        lines = [line.rstrip() for line in block.decode("utf-8", errors="replace").split("\n")]
+        if color:
+            lines = [red(line) for line in lines]
+        print("\n".join(lines))
 
 
-@attr.s
+@functools.lru_cache(maxsize=256)
+def _split(command: str) -> Tuple[str, ...]:
+    """Tokenize a kubectl subcommand, caching the result as the same ones recur a lot."""
+    return tuple(shlex.split(command))
+
+
+def _kubectl_prefix(kubeconfig_fmt: str, cluster: str, namespace: Optional[str], admin: bool) -> Tuple[str, ...]:
+    """Returns the invariant part of the kubectl command for a cluster/namespace pair."""
+    if admin:
+        # If the command is to be run as admin, we search for the admin kubeconfig
+        prefix = ["sudo"] + shlex.split(kubeconfig_fmt.format(namespace="admin", cluster=cluster))
+    else:
+        prefix = shlex.split(kubeconfig_fmt.format(namespace=namespace, cluster=cluster))
+    prefix.append("kubectl")
+    if namespace:
+        prefix.extend(["-n", namespace])
+    return tuple(prefix)
+
+
+# The parsed json responses of kubectl, by remote, cluster and namespace, then by command line.
+# Each response is stored along with the time it was fetched. The namespaces used least recently
+# are dropped once there are more than _json_cache_size of them.
+_CacheKey = Tuple[RemoteCommand, str, Optional[str]]
+_json_cache: "OrderedDict[_CacheKey, Dict[Tuple[str, ...], Tuple[float, Any]]]" = OrderedDict()
+_json_cache_size = 64
+# Responses are fetched from multiple threads
+_json_cache_lock = threading.Lock()
+
+
+@attr.s(slots=True, frozen=True)
 class Kubectl:
     """Class that allows running kubectl on a remote or local cluster"""
 
@@ -96,40 +242,151 @@ class Kubectl:
     # The namespace we're acting on
     namespace: Optional[str] = attr.ib()
     remote: RemoteCommand = attr.ib()
+    # Whether commands are run with admin privileges. Use the admin property to get such an instance.
+    privileged: bool = attr.ib(default=False, kw_only=True)
+    # The invariant part of the commands
+    _prefix: Tuple[str, ...] = attr.ib(init=False, default=(), eq=False, repr=False)
+    _admin: Optional["Kubectl"] = attr.ib(init=False, default=None, eq=False, repr=False)
     kubeconfig_fmt = "KUBECONFIG=/etc/kubernetes/{namespace}-{cluster}.config"
+    # Separates the outputs of the commands in a batch, followed by the return code.
+    batch_separator = "---K8SH-RC:"
+    # For how long, in seconds, the json responses are reused.
+    cache_ttl = 30
 
-    def _kubeconfig(self, admin: bool = False) -> str:
-        """Returns the kubeconfig file path."""
-        if admin:
-            # If the command is to be run as admin, we search for the admin kubeconfig
-            return "sudo " + self.kubeconfig_fmt.format(namespace="admin", cluster=self.cluster)
-        else:
-            return self.kubeconfig_fmt.format(namespace=self.namespace, cluster=self.cluster)
+    def __attrs_post_init__(self):
+        # Everything but the command itself is fixed for an instance, so build it once.
+        # The instance is frozen, hence the object.__setattr__ call.
+        object.__setattr__(
+            self, "_prefix", _kubectl_prefix(self.kubeconfig_fmt, self.cluster, self.namespace, self.privileged)
+        )
+
+    @property
+    def admin(self) -> "Kubectl":
+        """The same kubectl, but running commands with admin privileges."""
+        if self.privileged:
+            return self
+        if self._admin is None:
+            object.__setattr__(self, "_admin", attr.evolve(self, privileged=True))
+        return self._admin  # type: ignore
 
-    def _kubectl(self, command: str, admin: bool = False) -> List[str]:
+    def _kubectl(self, command: str) -> List[str]:
         """Returns the full command array for a kubectl invocation."""
-        if self.namespace is not None:
-            _cmd = "{} kubectl -n {} {}".format(self._kubeconfig(admin), self.namespace, command)
-        else:
-            _cmd = "{} kubectl {}".format(self._kubeconfig(admin), command)
-        return shlex.split(_cmd)
+        return [*self._prefix, *_split(command)]
+
+    def run_sync(self, command: str):
+        return self.remote.run_sync(self._kubectl(command))
+
+    def run(self, command: str) -> subprocess.CompletedProcess:
+        return self.remote.run(self._kubectl(command))
+
+    def json(self, command: str):
+        return self._query(command + " -o=json")
 
-    def run_sync(self, command: str, admin: bool = False):
-        return self.remote.run_sync(self._kubectl(command, admin))
+    def columns(self, command: str, items: str, fields: List[str]) -> List[List[str]]:
+        """Run a query, only getting back some fields of each element of the list at items.
 
-    def run(self, command: str, admin: bool = False) -> subprocess.CompletedProcess:
-        return self.remote.run(self._kubectl(command, admin))
+        Returns a row for each element, with the values of the fields as strings (empty if missing).
+        """
+        # Let kubectl pick out what we need, so that we don't transfer and parse the whole object.
+        # Only plain text comes out of the template, as older kubectl versions don't print
+        # the values found with jsonpath as json.
+        row = '{"\\t"}'.join(f"{{{field}}}" for field in fields)
+        return self._query(f"{command} -o=jsonpath='{{range {items}[*]}}{row}{{\"\\n\"}}{{end}}'", _rows)
 
-    def json(self, command: str, admin: bool = False):
-        command += " -o=json"
-        outcome = self.run(command, admin)
-        if outcome.returncode != 0:
+    def _query(self, command: str, parse: Callable[[bytes], Any] = json_loads):
+        """Run a command, returning its output as decoded by parse."""
+        argv = self._kubectl(command)
+        data = self._cached(argv)
+        if data is None:
+            outcome = self.remote.run(argv)
+            data = self._decode(command, outcome.returncode, outcome.stdout, outcome.stderr, parse)
+            self._store(argv, data)
+        return data
+
+    def _cached(self, argv: List[str]) -> Any:
+        """The cached response for a command line, if still fresh."""
+        key = (self.remote, self.cluster, self.namespace)
+        with _json_cache_lock:
+            try:
+                fetched, data = _json_cache[key][tuple(argv)]
+            except KeyError:
+                return None
+            _json_cache.move_to_end(key)
+        if time.monotonic() - fetched < self.cache_ttl:
+            return data
+        return None
+
+    def _store(self, argv: List[str], data: Any):
+        key = (self.remote, self.cluster, self.namespace)
+        now = time.monotonic()
+        with _json_cache_lock:
+            cache = _json_cache.setdefault(key, {})
+            _json_cache.move_to_end(key)
+            # Take the chance to drop whatever has expired.
+            for expired in [k for k, (fetched, _) in cache.items() if now - fetched >= self.cache_ttl]:
+                del cache[expired]
+            cache[tuple(argv)] = (now, data)
+            while len(_json_cache) > _json_cache_size:
+                _json_cache.popitem(last=False)
+
+    def invalidate(self):
+        """Forget the cached responses for this cluster and namespace, admin ones included."""
+        with _json_cache_lock:
+            _json_cache.pop((self.remote, self.cluster, self.namespace), None)
+
+    def json_batch(self, commands: List[str]) -> List:
+        """Run multiple queries in a single remote invocation, returns their outputs in order."""
+        return json_batch([(self, command) for command in commands])
+
+    def _decode(
+        self, command: str, returncode: int, stdout: bytes, stderr: bytes, parse: Callable[[bytes], Any] = json_loads
+    ):
+        if returncode != 0:
             raise k8shError(
                 "Error running {}: process returned with retcode: {}, error: {}".format(
-                    command, outcome.returncode, outcome.stderr.decode()
+                    command, returncode, stderr.decode("utf-8", errors="replace")
                 )
             )
         try:
-            return json.loads(outcome.stdout.decode())
+            # json can decode bytes directly, no need to make a str copy of the payload
+            return parse(stdout)
         except Exception as e:
-            raise k8shError("Error decoding json output: {}".format(str(e)))
+            raise k8shError("Error decoding the output: {}".format(str(e)))
+
+
+def _rows(output: bytes) -> List[List[str]]:
+    """Split the output of a jsonpath template in rows of tab-separated fields."""
+    return [line.split("\t") for line in output.decode("utf-8").splitlines()]
+
+
+def json_batch(queries: List[Tuple[Kubectl, str]]) -> List:
+    """Run multiple queries, even on different namespaces, in a single remote invocation.
+
+    All the queries must go through the same remote. Returns their outputs in order.
+    """
+    commands = [command + " -o=json" for _, command in queries]
+    argvs = [kubectl._kubectl(command) for (kubectl, _), command in zip(queries, commands)]
+    results = [kubectl._cached(argv) for (kubectl, _), argv in zip(queries, argvs)]
+    # Only run what we don't already know
+    todo = [i for i, data in enumerate(results) if data is None]
+    if not todo:
+        return results
+    remote = queries[todo[0]][0].remote
+    sep = Kubectl.batch_separator
+    script = " ".join("{}; printf '\\n{}%d\\n' $?;".format(shlex.join(argvs[i]), sep) for i in todo)
+    outcome = remote.run_script(script)
+    # We get back the output of each command followed by its return code, then the trailing newline.
+    parts = re.split(rb"\n" + re.escape(sep.encode()) + rb"(\d+)\n", outcome.stdout)
+    if len(parts) != 2 * len(todo) + 1:
+        raise k8shError(
+            "Error running {}: process returned with retcode: {}, error: {}".format(
+                ", ".join(commands[i] for i in todo),
+                outcome.returncode,
+                outcome.stderr.decode("utf-8", errors="replace"),
+            )
+        )
+    for i, stdout, rc in zip(todo, parts[0::2], parts[1::2]):
+        kubectl = queries[i][0]
+        results[i] = kubectl._decode(commands[i], int(rc), stdout, outcome.stderr)
+        kubectl._store(argvs[i], results[i])
+    return results
@@ -1,16 +1,46 @@
-import glob
 import fnmatch
-import os
+import functools
+import re
 import shlex
-from typing import Dict, List, Optional, Tuple
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
 
 import attr
 
 from k8sh import k8shError
-from k8sh.exec import Kubectl, RemoteCommand
+from k8sh.exec import Kubectl, RemoteCommand, json_batch
 
+# Characters that make a path fragment a glob
+GLOB_CHARS = frozenset("*?[")
+# How container runtimes prefix the container IDs
+CONTAINER_RUNTIME_PREFIXES = ("docker://", "containerd://", "cri-o://")
+# Maximum number of objects whose children are fetched at the same time.
+MAX_PARALLEL_FETCHES = 8
+_pool: Optional[ThreadPoolExecutor] = None
 
-@attr.s
+
+@functools.lru_cache(maxsize=256)
+def compile_match(maybe_glob: str) -> Callable[[str], bool]:
+    """Returns a function checking if a path fragment matches a glob or an exact match.
+
+    The same patterns tend to be used over and over, so the results are cached.
+    """
+    if GLOB_CHARS.isdisjoint(maybe_glob):
+        return maybe_glob.__eq__
+    match = re.compile(fnmatch.translate(maybe_glob)).match
+    return lambda fragment: match(fragment) is not None
+
+
+def _strip_runtime(container_id: str) -> str:
+    """Remove the runtime prefix from a container ID."""
+    for prefix in CONTAINER_RUNTIME_PREFIXES:
+        if container_id.startswith(prefix):
+            return container_id[len(prefix) :]
+    return container_id
+
+
+@attr.s(slots=True, weakref_slot=False)
 class KubeObject:
     """Generic kubernetes object wrapper"""
 
@@ -18,8 +48,25 @@ class KubeObject:
     kubectl: Kubectl = attr.ib()
     parent: Optional["KubeObject"] = attr.ib()
     _children: Optional[List["KubeObject"]] = attr.ib(init=False, default=None)
+    _root: Optional["KubeObject"] = attr.ib(init=False, default=None, eq=False, repr=False)
+    _fragment: str = attr.ib(init=False, default="", eq=False, repr=False)
+    _path: Optional[str] = attr.ib(init=False, default=None, eq=False, repr=False)
+    # The children by path fragment, along with the list it was built from.
+    _index: Optional[Tuple[List["KubeObject"], Dict[str, "KubeObject"]]] = attr.ib(
+        init=False, default=None, eq=False, repr=False
+    )
+    # The children we've queried one by one, before listing all of them
+    _fetched: Dict[str, "KubeObject"] = attr.ib(init=False, factory=dict, eq=False, repr=False)
+    # When the children were fetched from the cluster
+    _listed_at: Optional[float] = attr.ib(init=False, default=None, eq=False, repr=False)
     kind: str = ""
+    # Prepended to the name to get the path fragment
+    fragment_prefix: str = ""
     is_deletable: bool = True
+    # Whether finding the children needs a query to the cluster
+    has_children: bool = True
+    # Whether a single child can be queried without listing all of them
+    can_fetch_child: bool = False
 
     @property
     def children(self) -> List["KubeObject"]:
@@ -30,24 +77,31 @@ class KubeObject:
         """Remove any response cache we might have saved"""
         raise NotImplementedError("refresh() needs to be implemented.")
 
+    def is_stale(self) -> bool:
+        """Whether the children were fetched longer ago than kubectl responses are cached for."""
+        return self._listed_at is not None and time.monotonic() - self._listed_at > self.kubectl.cache_ttl
+
+    def __attrs_post_init__(self):
+        self._fragment = self.fragment_prefix + self.name
+
     def path_fragment(self) -> str:
         """The path fragment for this object"""
-        return self.name
+        return self._fragment
 
     def match(self, maybe_glob: str) -> bool:
         """Checks if the current object path fragment matches a glob or an exact match"""
-        if not glob.has_magic(maybe_glob):
-            return self.path_fragment() == maybe_glob
-        else:
-            return fnmatch.fnmatch(self.path_fragment(), maybe_glob)
+        return compile_match(maybe_glob)(self.path_fragment())
 
     @property
     def root(self) -> "KubeObject":
         """The root element of the hierarchy"""
-        ptr = self
-        while ptr.parent is not None:
-            ptr = ptr.parent
-        return ptr
+        # The hierarchy never changes, so we only need to walk it once.
+        if self._root is None:
+            if self.parent is None:
+                self._root = self
+            else:
+                self._root = self.parent.root
+        return self._root
 
     def cd(self, val) -> Tuple["KubeObject", str]:
         """Switch to another object."""
@@ -67,32 +121,60 @@ class KubeObject:
             else:
                 return (self.parent, val[3:])
 
-        # Normal cd support
-        for el in self.children:
-            frag = el.path_fragment()
-            # Precise match, we're at the end of the hierarchy
-            if val == frag:
-                return (el, "")
-            # If no precise match is found, let's try
-            # as a prefix path.
-            frag += "/"
-            if val.startswith(frag):
-                residual = val.replace(frag, "")
-                return (el, residual)
+        # Normal cd support: fragments never contain a slash, so
+        # look up the first one and leave the rest for the child.
+        frag, _, residual = val.partition("/")
+        child = self.get_child(frag)
+        if child is not None:
+            return (child, residual)
         # No result was found. This is an error.
         raise k8shError(f"Could not find {val} in {self.path_fragment()}")
 
+    def _child_index(self) -> Dict[str, "KubeObject"]:
+        """The children of this object by path fragment."""
+        children = self.children
+        # Rebuild it whenever the children are fetched again.
+        if self._index is None or self._index[0] is not children:
+            self._index = (children, {el.path_fragment(): el for el in children})
+        return self._index[1]
+
+    def get_child(self, fragment: str) -> Optional["KubeObject"]:
+        """The child with the given path fragment, if any."""
+        # If we haven't listed the children yet, it's cheaper to just ask for the one we need.
+        if self._children is None and self.can_fetch_child:
+            if fragment not in self._fetched:
+                child = self._fetch_child(fragment)
+                if child is None:
+                    return None
+                self._fetched[fragment] = child
+            return self._fetched[fragment]
+        return self._child_index().get(fragment)
+
+    def _adopt(self, children: List["KubeObject"]) -> List["KubeObject"]:
+        """Swap in the children we had already queried one by one, so that they keep what they know."""
+        if self._fetched:
+            children = [self._fetched.get(child.path_fragment(), child) for child in children]
+            self._fetched = {}
+        return children
+
+    def _fetch_child(self, fragment: str) -> Optional["KubeObject"]:
+        """Query the cluster for a single child."""
+        raise NotImplementedError("_fetch_child() needs to be implemented if can_fetch_child is set.")
+
     @property
     def path(self) -> str:
         """The full path of the object"""
-        hierarchy = [self.path_fragment()]
-        cur_obj = self
-        while cur_obj.parent is not None:
-            cur_obj = cur_obj.parent
-            hierarchy.append(cur_obj.path_fragment())
-
-        hierarchy.reverse()
-        return os.path.join(*hierarchy)
+        # Objects never move around the hierarchy, so compute it only once.
+        if self._path is None:
+            if self.parent is None:
+                self._path = self.path_fragment()
+            else:
+                # The parent caches its own path, so we only need to append to it.
+                parent_path = self.parent.path
+                if not parent_path.endswith("/"):
+                    parent_path += "/"
+                self._path = parent_path + self.path_fragment()
+        return self._path
 
     def eventlog(self, sort_by: str = ".lastTimestamp"):
         """Read the events log, sorting by a provided key (by default, by timestamp)."""
@@ -104,23 +186,32 @@ class KubeObject:
         """Delete the object"""
         if not self.is_deletable:
             raise k8shError(f"Objects of kind '{self.kind}' cannot be deleted")
-        result = self.kubectl.run(f"delete {self.kind} {self.name}", True)
+        result = self.kubectl.admin.run(f"delete {self.kind} {self.name}")
         if result.returncode != 0:
             raise k8shError(f"Could not remove {self.path}: {result.stderr.decode('utf-8')}")
+        # The listing we come from is now stale.
+        if self.parent is not None:
+            self.parent.refresh()
 
 
-@attr.s
+@attr.s(slots=True, weakref_slot=False)
 class Pod(KubeObject):
     kind: str = "pod"
+    fragment_prefix = "pod."
+    # The pod description, if we already have it from listing the namespace
+    data: Optional[Dict] = attr.ib(default=None, kw_only=True, eq=False, repr=False)
     _hostname: Optional[str] = attr.ib(init=False, default=None)
 
     def _gather_data(self):
+        if self.data is None:
+            self.data = self.kubectl.json(f"get pods '{self.name}'")
+        container_data = self.data
         self._children = []
-        container_data = self.kubectl.json(f"get pods '{self.name}'", False)
+        self._listed_at = time.monotonic()
         self._hostname = container_data["spec"]["nodeName"]
         for status in container_data["status"]["containerStatuses"]:
             container = Container(status["name"], self.kubectl, self)
-            container.ID = status["containerID"].replace("docker://", "")
+            container.ID = _strip_runtime(status["containerID"])
             container.set_remote(self._hostname)
             self._children.append(container)
 
@@ -133,36 +224,46 @@ class Pod(KubeObject):
     @property
     def hostname(self) -> str:
         if self._hostname is None:
-            self._gather_data()
+            if self.data is not None:
+                # No need to set up the containers just for this.
+                self._hostname = self.data["spec"].get("nodeName")
+            else:
+                self._gather_data()
         if self._hostname is None:
             raise k8shError("Could not fetch the hostname.")
         return self._hostname
 
-    def path_fragment(self):
-        return f"pod.{self.name}"
-
     def refresh(self):
         self._children = None
         self._hostname = None
+        self.data = None
+        self.kubectl.invalidate()
 
 
-@attr.s
+@attr.s(slots=True, weakref_slot=False)
 class Container(KubeObject):
     kind: str = "container"
     ID: str = attr.ib(init=False, default="")
     _remote: Optional[RemoteCommand] = attr.ib(init=False, default=None)
+    # The PID of the main process of the container, once we know it
+    _pid: Optional[str] = attr.ib(init=False, default=None)
     is_deletable = False
+    has_children = False
 
     def set_remote(self, hostname: str):
-        self._remote = RemoteCommand(hostname, self.kubectl.remote.ssh_opts, "")
+        remote = self.kubectl.remote
+        # If the control path is expanded per-host by ssh, we can share it with the kubectl host.
+        # Otherwise we'd end up funneling our commands through the master connection to the kubectl host.
+        master_path = remote.master_path if remote.shares_master_path() else ""
+        # All the containers on a host share the same remote.
+        self._remote = RemoteCommand.get(hostname, remote.ssh_opts, master_path)
 
     @property
     def children(self) -> List["KubeObject"]:
         return []
 
     def refresh(self):
-        # noop for containers
-        pass
+        self._pid = None
 
     def ps(self):
         """
@@ -182,12 +283,23 @@ class Container(KubeObject):
         """
         if self._remote is None:
             raise k8shError("No remote host defined, impossible to execute.")
-        # Find the main pid of the container
-        res = self._remote.run(["sudo", "docker", "inspect", "-f", "'{{.State.Pid}}'", self.ID])
-        if res.returncode != 0:
-            raise k8shError("Error finding the PID of the container: exitcode {res.returncode}: {res.stderr.decode()}")
-        pid = res.stdout.decode().rstrip()
-        cmd = ["sudo", "nsenter", "-t", pid] + shlex.split(arg)
+        inspect = ["docker", "inspect", "-f", "{{.State.Pid}}", self.ID]
+        # Looking the PID up with docker is slow, so only do it once.
+        if self._pid is None:
+            res = self._remote.run(["sudo"] + inspect)
+            if res.returncode != 0:
+                raise k8shError(
+                    f"Error finding the PID of the container: exitcode {res.returncode}: {res.stderr.decode()}"
+                )
+            self._pid = res.stdout.decode().rstrip()
+        # If the container was restarted, the PID we know could now belong to anything else:
+        # make sure it's still in the container's cgroup, else look it up again.
+        check = f"grep -qF {shlex.quote(str(self.ID))} /proc/$pid/cgroup 2>/dev/null"
+        script = (
+            f"pid={shlex.quote(self._pid)}; {check} || pid=$({shlex.join(map(str, inspect))}) || exit; "
+            f'exec nsenter -t "$pid" {shlex.join(shlex.split(arg))}'
+        )
+        cmd = ["sudo", "sh", "-c", script]
         rc = self._remote.run_sync(cmd)
         if rc != 0:
             raise k8shError("Command {} exited with return code {}".format(" ".join(cmd), rc))
@@ -217,35 +329,66 @@ class Container(KubeObject):
         if self.parent is None:
             raise k8shError("Could not find a linked pod, container badly initialized.")
         # This needs to run with admin privileges
-        rc = self.kubectl.run_sync(f"exec {self.parent.name} -c {self.name} -- {arg}", True)
+        rc = self.kubectl.admin.run_sync(f"exec {self.parent.name} -c {self.name} -- {arg}")
         if rc != 0:
             raise k8shError(f"Execution of '{arg}' failed with status code {rc}")
 
 
+@attr.s(slots=True, weakref_slot=False)
 class Namespace(KubeObject):
     kind: str = "namespace"
+    # How to get the children
+    list_command = "get pods,services"
+    can_fetch_child = True
 
     @property
     def children(self) -> List["KubeObject"]:
         if self._children is None:
-            self._children = []
-            for r in self.kubectl.json("get pods", False)["items"]:
-                name = r["metadata"]["name"]
-                self._children.append(Pod(name=name, kubectl=self.kubectl, parent=self))
-            for srv in self.kubectl.json("get services", False)["items"]:
-                name = srv["metadata"]["name"]
-                self._children.append(Service(name=name, kubectl=self.kubectl, parent=self))
-        return self._children
+            # Fetch everything in one go, then sort it out by kind.
+            self._set_children(self.kubectl.json(self.list_command))
+        return self._children  # type: ignore
+
+    def _set_children(self, listing: Dict):
+        children: List[KubeObject] = []
+        for item in listing["items"]:
+            name = item["metadata"]["name"]
+            if item["kind"] == "Pod":
+                # The listing has all we need to know about the pod.
+                children.append(Pod(name=name, kubectl=self.kubectl, parent=self, data=item))
+            elif item["kind"] == "Service":
+                children.append(Service(name=name, kubectl=self.kubectl, parent=self))
+        self._children = self._adopt(children)
+        self._listed_at = time.monotonic()
+
+    def _fetch_child(self, fragment: str) -> Optional[KubeObject]:
+        kind, _, name = fragment.partition(".")
+        if kind == "pod":
+            data = _get_object(self.kubectl, f"get pods '{name}'")
+            if data is not None:
+                return Pod(name=name, kubectl=self.kubectl, parent=self, data=data)
+        elif kind == "service":
+            if _get_object(self.kubectl, f"get services '{name}'") is not None:
+                return Service(name=name, kubectl=self.kubectl, parent=self)
+        return None
+
+    @classmethod
+    def fetch_many(cls, namespaces: List["Namespace"]):
+        """Fetch the children of namespaces sharing a remote with a single remote command."""
+        listings = json_batch([(ns.kubectl, cls.list_command) for ns in namespaces])
+        for ns, listing in zip(namespaces, listings):
+            ns._set_children(listing)
 
     def refresh(self):
         self._children = None
+        self._fetched = {}
+        self.kubectl.invalidate()
 
 
+@attr.s(slots=True, weakref_slot=False)
 class Service(KubeObject):
     kind: str = "service"
-
-    def path_fragment(self):
-        return f"service.{self.name}"
+    fragment_prefix = "service."
+    has_children = False
 
     @property
     def children(self) -> List["KubeObject"]:
@@ -253,18 +396,16 @@ class Service(KubeObject):
 
     def get(self) -> Dict:
         """Get the data about the service"""
-        service = self.kubectl.json(f"get services {self.name}")
-        metadata = service["metadata"]
-        ports = service["spec"]["ports"]
+        ports = self.kubectl.columns(f"get services {self.name}", ".spec.ports", [".name", ".targetPort", ".nodePort"])
         return {
-            "name": f"{metadata['namespace']}/services/{metadata['name']}",
+            "name": f"{self.kubectl.namespace}/services/{self.name}",
             "ports": [
                 {
-                    "name": p["name"],
-                    "target": p["targetPort"],
-                    "nodeport": p.get("nodePort", None),
+                    "name": name,
+                    "target": _port(target),
+                    "nodeport": _port(nodeport) if nodeport else None,
                 }
-                for p in ports
+                for name, target, nodeport in ports
             ],
         }
 
@@ -273,35 +414,93 @@ class Service(KubeObject):
         pass
 
 
+# The constructor is our own, don't let attrs replace it.
+@attr.s(slots=True, weakref_slot=False, init=False)
 class Cluster(KubeObject):
     kind: str = "cluster"
     is_deletable = False
+    can_fetch_child = True
 
     def __init__(self, name: str, kubectl: Kubectl):
-        super().__init__(name, kubectl, None)
-        self.kubectl.cluster = self.name
-        self.kubectl.namespace = "admin"
+        super().__init__(name, Kubectl(name, "admin", kubectl.remote), None)
 
     def path_fragment(self) -> str:
         return "/"
 
+    def _fetch_child(self, fragment: str) -> Optional[KubeObject]:
+        if _get_object(self.kubectl.admin, f"get namespaces '{fragment}'") is None:
+            return None
+        return Namespace(name=fragment, kubectl=Kubectl(self.name, fragment, self.kubectl.remote), parent=self)
+
     @property
     def children(self) -> List["KubeObject"]:
         if self._children is None:
-            self._children = []
-            for r in self.kubectl.json("get namespaces", True)["items"]:
+            items = self.kubectl.admin.json("get namespaces")["items"]
+            children: List[KubeObject] = []
+            for r in items:
                 name = r["metadata"]["name"]
                 k = Kubectl(self.name, name, self.kubectl.remote)
-                self._children.append(Namespace(name=name, kubectl=k, parent=self))
+                children.append(Namespace(name=name, kubectl=k, parent=self))
+            self._children = self._adopt(children)
+            self._listed_at = time.monotonic()
         return self._children
 
     def refresh(self):
+        # The namespaces' cached listings would be just as stale.
+        for child in (self._children or []) + list(self._fetched.values()):
+            child.refresh()
         self._children = None
+        self._fetched = {}
+        self.kubectl.invalidate()
 
     def eventlog(self, sort_by: str = ".lastTimestamp"):
         """Get all events on the current cluster."""
         # We want the events for all namespaces at cluster level.
         # So: run as admin, append -A
-        rec = self.kubectl.run_sync(f"get events --sortBy='{sort_by}' -A", True)
+        rec = self.kubectl.admin.run_sync(f"get events --sortBy='{sort_by}' -A")
         if rec != 0:
             raise k8shError("Could not read the event log")
+
+
+def _port(port: str):
+    """A port as found in a service: a number, or the name of a port of the pods."""
+    return int(port) if port.isdigit() else port
+
+
+def _get_object(kubectl: Kubectl, command: str) -> Optional[Dict]:
+    """Get a single object, or None if it doesn't exist."""
+    try:
+        return kubectl.json(command)
+    except k8shError as e:
+        if "(NotFound)" in str(e):
+            return None
+        raise
+
+
+def prefetch(objects: List[KubeObject]):
+    """Fetch the children of multiple objects concurrently."""
+    todo = [obj for obj in objects if obj.has_children and obj._children is None]
+    # Namespaces on the same remote can be listed all at once.
+    by_remote: Dict[RemoteCommand, List[Namespace]] = {}
+    for obj in todo:
+        if isinstance(obj, Namespace):
+            by_remote.setdefault(obj.kubectl.remote, []).append(obj)
+    for namespaces in by_remote.values():
+        if len(namespaces) > 1:
+            Namespace.fetch_many(namespaces)
+    # Pods from a namespace listing already have all they need.
+    todo = [obj for obj in todo if obj._children is None and not (isinstance(obj, Pod) and obj.data is not None)]
+    # Not worth handing a single query to another thread.
+    if len(todo) < 2:
+        return
+    # Consume the results so that any error gets raised here.
+    for _ in _fetch_pool().map(lambda obj: obj.children, todo):
+        pass
+
+
+def _fetch_pool() -> ThreadPoolExecutor:
+    """The threads fetching children concurrently, started on first use and reused afterwards."""
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=MAX_PARALLEL_FETCHES, thread_name_prefix="k8sh-fetch")
+    return _pool
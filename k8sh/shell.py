@@ -1,14 +1,14 @@
+import bisect
 import os
+import time
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import cmd2  # type: ignore
 
 from k8sh import blue, k8shConfigPath, k8shError, kubernetes, red, setup, ConfigProfiles, Config
 from k8sh.exec import Kubectl, RemoteCommand
 
-from wmflib.interactive import ask_input
-
 CAT_NAV = "Kubernetes navigation"
 CAT_CONT = "Container-level debugging"
 CAT_SERV = "Service information"
@@ -16,6 +16,14 @@ CAT_ADMIN = "Kubernetes administration"
 
 # Maximum number of queries to perform for any command.
 MAX_QUERY_LENGTH = 15
+# Warning for requests exceeding it.
+TOO_WIDE = "Your request is too wide; to avoid disruptions to the API, you should narrow your pattern."
+# Kinds of objects whose children can be removed.
+REMOVABLE_PARENTS = frozenset(["cluster", "namespace"])
+# For how long, in seconds, completions for the same path are reused.
+COMPLETION_TTL = 2
+# Valid answers when asking for confirmation.
+YES_NO = ("y", "n", "Y", "N", "Yes", "No")
 
 
 class KubeCmd(cmd2.Cmd):
@@ -23,6 +31,15 @@ class KubeCmd(cmd2.Cmd):
         self.remote: RemoteCommand = remote
         self.current: kubernetes.KubeObject = kubernetes.KubeObject("null", Kubectl("", "", self.remote), None)
         self.config: ConfigProfiles = config
+        # The clusters we've used so far, along with everything we've fetched about them.
+        self._clusters: Dict[str, kubernetes.Cluster] = {}
+        # The last completion candidates: the object and path they were computed from, when, and the candidates.
+        self._completions: Tuple[Optional[kubernetes.KubeObject], str, float, List[str]] = (None, "", 0.0, [])
+        # The prompts we rendered, by id of the object they were rendered for. We keep
+        # the object too, so that its id can't be reused.
+        self._prompts: Dict[int, Tuple[kubernetes.KubeObject, str]] = {}
+        # The cluster names, as shown in the prompt
+        self._colored_clusters: Dict[str, str] = {}
         super().__init__(*args)
 
     def _switch_profile(self, config: Config):
@@ -32,7 +49,15 @@ class KubeCmd(cmd2.Cmd):
             self.remote = RemoteCommand(config.kubectl_host, config.ssh_opts, config.ssh_controlmaster_path)
             # Ensure the master path has an active connection to funnel our commands through
             self.remote.open()
-        Kubectl.kubeconfig_fmt = config.kubeconfig_format
+            self._forget_clusters()
+        if Kubectl.kubeconfig_fmt != config.kubeconfig_format:
+            Kubectl.kubeconfig_fmt = config.kubeconfig_format
+            self._forget_clusters()
+
+    def _forget_clusters(self):
+        """Drop the clusters we've used, and whatever refers to their objects."""
+        self._clusters.clear()
+        self._prompts.clear()
 
     def _check_current(self, desired_type: Optional[str] = None):
         """Check we have a valid current object"""
@@ -41,72 +66,104 @@ class KubeCmd(cmd2.Cmd):
         if desired_type is not None and self.current.kind != desired_type:
             raise k8shError(f"Invalid context: {self.current.kind}, should be {desired_type}")
 
-    def cd(self, val: str):
+    def cd(self, val: str) -> None:
         self._check_current()
         if not val:
             # Rewind to cluster level
             while self.current.parent is not None:
                 self.current = self.current.parent
                 print(self.current)
-            return
-        next_element = self.current
+        else:
+            self.current = self._resolve(self.current, val)
+        # If we listed what's here a while ago, things might have changed since.
+        if self.current.is_stale():
+            self.current.refresh()
+
+    def _resolve(self, start: kubernetes.KubeObject, val: str) -> kubernetes.KubeObject:
+        """Find the object at path val, relative to start."""
         while val != "":
-            next_element, val = next_element.cd(val)
-        self.current = next_element
+            start, val = start.cd(val)
+        return start
 
     def ls(self, arg: cmd2.Statement) -> List[kubernetes.KubeObject]:
+        return self._ls_path(arg.args)
+
+    def _ls_path(self, search: str) -> List[kubernetes.KubeObject]:
+        """Find the objects matching a path, which can contain globs."""
         self._check_current()
         queries_performed = 0
         # Simple case: no arguments
-        if arg.args == "":
+        if search == "":
             return self.current.children
         # If we have an argument, we have various cases to consider:
         # 1 - is this a glob?
         # 2 - is this a multi-level search?
-        search = arg.args
         ptr = [self.current]
         # Split the path in multiple
         for part in search.split("/"):
-            matches: List[kubernetes.KubeObject] = []
+            # Different paths can lead to the same object, keep each only once.
+            matches: Dict[int, kubernetes.KubeObject] = {}
             # We are listing a directory, just return all elements
             if part == "":
+                kubernetes.prefetch(ptr)
                 for obj in ptr:
-                    matches.extend(obj.children)
+                    for child in obj.children:
+                        matches[id(child)] = child
             elif part == "..":
                 for obj in ptr:
                     if obj.parent is not None:
-                        matches.append(obj.parent)
+                        matches[id(obj.parent)] = obj.parent
             else:
                 # Non-empty fragment
-                for obj in ptr:
-                    queries_performed += 1
-                    for child in obj.children:
-                        if child.match(part):
-                            matches.append(child)
+                queries_performed += len(ptr)
+                # If we're going to perform more queries than the limit, warn the user, return.
+                # Looking into a single object is fine, whatever came before it.
+                if len(ptr) > 1 and queries_performed > MAX_QUERY_LENGTH:
+                    print(red(TOO_WIDE))
+                    return []
+                if kubernetes.GLOB_CHARS.isdisjoint(part):
+                    # Not a glob, just look the child up, which doesn't need a full listing.
+                    for obj in ptr:
+                        found = obj.get_child(part)
+                        if found is not None:
+                            matches[id(found)] = found
+                else:
+                    kubernetes.prefetch(ptr)
+                    match = kubernetes.compile_match(part)
+                    for obj in ptr:
+                        for child in obj.children:
+                            if match(child.path_fragment()):
+                                matches[id(child)] = child
 
             # If we found no matches, stop
             if not matches:
                 return []
-            # If we performed more queries than the limit, warn the user, return
-            if queries_performed > MAX_QUERY_LENGTH:
-                print(red("Your request is too wide; to avoid disruptions to the API, you should narrow your pattern."))
-                return []
             # Finished finding matches, move the pointer
-            ptr = matches
+            ptr = list(matches.values())
         return ptr
 
-    def _prompt(self):
+    def _prompt(self) -> str:
+        # Objects never move in the hierarchy, so their prompt never changes.
+        cached = self._prompts.get(id(self.current))
+        if cached is not None and cached[0] is self.current:
+            return cached[1]
+        prompt = self._render_prompt()
+        self._prompts[id(self.current)] = (self.current, prompt)
+        return prompt
+
+    def _render_prompt(self) -> str:
         layer = self.current.kind
         # Root layer
         if layer == "":
             return "NONE (root) $ "
         # Find the cluster name
-        c = self.current
-        while c.kind != "cluster":
-            if c.parent is None:
-                raise k8shError(f"Found a {c.kind} object '{c.name}' without a parent. Something is very wrong.")
-            c = c.parent
-        cl = red(c.name)
+        c = self.current.root
+        if c.kind != "cluster":
+            raise k8shError(f"Found a {c.kind} object '{c.name}' without a parent. Something is very wrong.")
+        # The cluster name is the same for every object we visit, color it only once.
+        cl = self._colored_clusters.get(c.name)
+        if cl is None:
+            cl = self._colored_clusters[c.name] = red(c.name)
         path = blue(self.current.path)
         return f"{cl}:{path} ({layer})$ "
 
@@ -133,9 +190,16 @@ class KubeCmd(cmd2.Cmd):
         # Switch to the correct config profile
         config = self.config.get(str(arg))
         self._switch_profile(config)
-        # Now initialize the first cluster object.
-        kubectl = Kubectl(arg, "", self.remote)
-        self.current = kubernetes.Cluster(arg, kubectl)
+        # Now initialize the first cluster object, unless we've been there already.
+        name = str(arg)
+        if name not in self._clusters:
+            self._clusters[name] = kubernetes.Cluster(name, Kubectl(name, "", self.remote))
+        else:
+            # Using a cluster again is how to get a fresh view of it.
+            self._clusters[name].refresh()
+            self._prompts.clear()
+            self._completions = (None, "", 0.0, [])
+        self.current = self._clusters[name]
 
     def do_exit(self, arg):
         """Exit the program"""
@@ -157,7 +221,8 @@ class KubeCmd(cmd2.Cmd):
         level.
         """
         try:
-            self.cd(arg)
+            # cmd2 passes a Statement, which can't be used as a dict key
+            self.cd(str(arg))
         except k8shError as e:
             print(red(str(e)))
 
@@ -167,7 +232,8 @@ class KubeCmd(cmd2.Cmd):
         except k8shError:
             return []
         if text == "":
-            return [c.path_fragment() for c in self.current.children]
+            base = ""
+            to_suggest = ""
         elif text == "..":
             base = ".."
             to_suggest = text[3:]
@@ -179,21 +245,28 @@ class KubeCmd(cmd2.Cmd):
         else:
             base = ""
             to_suggest = text
-        # save the current object, then move to the base
-        cur = self.current
         try:
-            if base != "":
-                self.cd(base)
-            return [
-                os.path.join(base, c.path_fragment())
-                for c in self.current.children
-                if c.path_fragment().startswith(to_suggest)
-            ]
+            fragments = self._child_fragments(base)
         except k8shError:
             return []
-        finally:
-            # reset the current object
-            self.current = cur
+        # The fragments are sorted, so the candidates are all next to each other.
+        candidates = []
+        for i in range(bisect.bisect_left(fragments, to_suggest), len(fragments)):
+            if not fragments[i].startswith(to_suggest):
+                break
+            candidates.append(os.path.join(base, fragments[i]))
+        return candidates
+
+    def _child_fragments(self, base: str) -> List[str]:
+        """The sorted path fragments of the children of base, relative to the current object."""
+        # Every TAB press ends up here, and those come in bursts.
+        now = time.monotonic()
+        obj, cached_base, computed, fragments = self._completions
+        if obj is self.current and cached_base == base and now - computed < COMPLETION_TTL:
+            return fragments
+        fragments = sorted(c.path_fragment() for c in self._resolve(self.current, base).children)
+        self._completions = (self.current, base, now, fragments)
+        return fragments
 
     @cmd2.with_category(CAT_NAV)
     def do_ls(self, arg):
@@ -216,11 +289,17 @@ class KubeCmd(cmd2.Cmd):
         to_remove = self.current.path
         if not to_remove.endswith("/"):
             to_remove += "/"
+        prefix_len = len(to_remove)
+        lines = []
         for obj in listed:
             if obj.kind == "cluster":
-                print("/")
+                lines.append("/")
             else:
-                print(obj.path.replace(to_remove, "", 1))
+                path = obj.path
+                lines.append(path[prefix_len:] if path.startswith(to_remove) else path)
+        # Print everything at once, long listings are much faster this way.
+        if lines:
+            print("\n".join(lines))
 
     @cmd2.with_category(CAT_CONT)
     def do_ps(self, arg):
@@ -341,7 +420,8 @@ class KubeCmd(cmd2.Cmd):
         """
         try:
             self._check_current()
-            to_delete: List[kubernetes.KubeObject] = []
+            # Different arguments can match the same object, delete each only once.
+            to_delete: Dict[int, kubernetes.KubeObject] = {}
             interactive = False
             for argument in arg.arg_list:
                 # fat fingers protection: for an "all" glob, we switch to interactive mode automatically
@@ -350,21 +430,24 @@ class KubeCmd(cmd2.Cmd):
                 if argument == "-i":
                     interactive = True
                     continue
-                matching = self.ls(cmd2.Statement(argument, f"ls {argument}", "ls", [argument]))
+                matching = self._ls_path(argument)
                 # check we're matching something, and that we can delete that something
                 if len(matching) == 0:
                     print(red(f"{argument}: no such object."))
                     continue
                 for obj in matching:
-                    if obj.parent is None or obj.parent.kind not in ["cluster", "namespace"]:
+                    if obj.parent is None or obj.parent.kind not in REMOVABLE_PARENTS:
                         print(red(f"Cannot remove object {obj.path} (from {argument}"))
                     else:
-                        to_delete.append(obj)
+                        to_delete[id(obj)] = obj
 
             ask = interactive and len(to_delete) > 1
-            for obj in to_delete:
+            if ask:
+                # wmflib is slow to import, and only needed here.
+                from wmflib.interactive import ask_input
+            for obj in to_delete.values():
                 if ask:
-                    resp = ask_input("Should object {obj.path} be deleted? (y/n)", ["y", "n", "Y", "N", "Yes", "No"])
+                    resp = ask_input(f"Should object {obj.path} be deleted? (y/n)", YES_NO)
                     if resp.lower().startswith("n"):
                         continue
                 obj.delete()
@@ -373,7 +456,8 @@ class KubeCmd(cmd2.Cmd):
             print(red(str(e)))
             return 1
         finally:
-            self.current.refresh()
+            # The objects we deleted have refreshed their parents, but completions don't know.
+            self._completions = (None, "", 0.0, [])
 
 
 def from_configfile(path: Path) -> KubeCmd:
@@ -389,7 +473,7 @@ def from_configfile(path: Path) -> KubeCmd:
     return sh
 
 
-def main():
+def main() -> None:
     configfile = k8shConfigPath()
     sh = from_configfile(configfile)
     sh.cmdloop()
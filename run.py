@@ -1,11 +1,4 @@
-from k8sh import k8shConfigPath, shell
-
-
-def main():
-    configfile = k8shConfigPath()
-    sh = shell.from_configfile(configfile)
-    sh.cmdloop()
-
+from k8sh.shell import main
 
 if __name__ == "__main__":
     main()
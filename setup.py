@@ -10,6 +10,10 @@ setup(
     author_email="lavagetto@gmail.com",
     url="https://github.com/lavagetto/k8sh",
     install_requires=["cmd2", "pyyaml", "xdg", "colorama", "wmflib"],
+    extras_require={
+        # Faster parsing of the kubectl output
+        "fast": ["orjson"],
+    },
     zip_safe=False,
     packages=find_packages(),
     entry_points={
@@ -24,6 +28,8 @@ setup(
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: 3.9",
         "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: Implementation :: CPython",
+        "Programming Language :: Python :: Implementation :: PyPy",
         "Topic :: System :: Clustering",
     ],
 )
@@ -0,0 +1,116 @@
+import datetime
+import json
+import os
+from pathlib import Path
+
+import k8sh
+import pytest
+
+
+@pytest.fixture
+def configfile(tmp_path) -> Path:
+    path = tmp_path / "k8shrc.yaml"
+    path.write_text("kubectl_host: kube.example.com\n")
+    return path
+
+
+def _cache(configfile: Path) -> Path:
+    return configfile.with_suffix(".yaml.json")
+
+
+def test_read_config_cache(configfile):
+    """The parsed configuration is saved, and used while the file doesn't change"""
+    assert k8sh._read_config(configfile) == {"kubectl_host": "kube.example.com"}
+    cached = json.loads(_cache(configfile).read_text())
+    assert cached["config"] == {"kubectl_host": "kube.example.com"}
+    # Prove the cache is what gets read
+    cached["config"] = {"kubectl_host": "cached.example.com"}
+    _cache(configfile).write_text(json.dumps(cached))
+    assert k8sh._read_config(configfile) == {"kubectl_host": "cached.example.com"}
+
+
+def test_read_config_stale(configfile):
+    """A change to the file is picked up, even if it doesn't make it newer than the cache"""
+    k8sh._read_config(configfile)
+    old = configfile.stat()
+    configfile.write_text("kubectl_host: other.example.com\n")
+    assert k8sh._read_config(configfile) == {"kubectl_host": "other.example.com"}
+    # Restoring an older file with its mtime (like cp -p would)
+    configfile.write_text("kubectl_host: old.example.com\n")
+    os.utime(configfile, ns=(old.st_atime_ns, old.st_mtime_ns - 10**9))
+    assert k8sh._read_config(configfile) == {"kubectl_host": "old.example.com"}
+
+
+@pytest.mark.parametrize("content", ["", "not json", "[]", '{"source": 1}', '{"config": {}}'])
+def test_read_config_bad_cache(configfile, content):
+    """A cache we can't make sense of is ignored, and replaced"""
+    _cache(configfile).write_text(content)
+    assert k8sh._read_config(configfile) == {"kubectl_host": "kube.example.com"}
+    assert json.loads(_cache(configfile).read_text())["config"] == {"kubectl_host": "kube.example.com"}
+
+
+@pytest.mark.parametrize(
+    "content,expected",
+    [
+        ("since: 2020-01-01\n", {"since": datetime.date(2020, 1, 1)}),
+        ("profiles:\n  2023:\n    kubectl_host: foo\n", {"profiles": {2023: {"kubectl_host": "foo"}}}),
+    ],
+)
+def test_read_config_not_json(configfile, content, expected):
+    """Configurations json can't represent faithfully are used as they are, and not cached"""
+    configfile.write_text(content)
+    assert k8sh._read_config(configfile) == expected
+    assert not _cache(configfile).exists()
+    assert k8sh._read_config(configfile) == expected
+
+
+@pytest.mark.parametrize("content", ["", "\n  \n"])
+def test_read_config_empty(configfile, content):
+    """An empty file is an empty configuration"""
+    configfile.write_text(content)
+    assert k8sh._read_config(configfile) == {}
+
+
+def test_setup(configfile):
+    """The configuration is loaded once, unless the file changes"""
+    configfile.write_text("kubectl_host: kube.example.com\nprofiles:\n  test:\n    kubectl_host: test.example.com\n")
+    profiles = k8sh.setup(configfile)
+    assert profiles.default.kubectl_host == "kube.example.com"
+    assert profiles.get("test").kubectl_host == "test.example.com"
+    assert profiles.get("other") is profiles.default
+    assert k8sh.setup(configfile) is profiles
+    configfile.write_text("kubectl_host: other.example.com\n")
+    os.utime(configfile, ns=(0, configfile.stat().st_mtime_ns + 10**9))
+    assert k8sh.setup(configfile).default.kubectl_host == "other.example.com"
+
+
+def test_setup_missing(tmp_path):
+    """A missing file gives the default configuration"""
+    assert k8sh.setup(tmp_path / "nope.yaml").default == k8sh.Config()
+
+
+@pytest.fixture
+def config_dirs(tmp_path, monkeypatch):
+    """Point the xdg and legacy configuration paths to a temporary directory"""
+    import xdg
+
+    monkeypatch.setattr(xdg, "XDG_CONFIG_HOME", tmp_path / "config")
+    monkeypatch.setenv("HOME", str(tmp_path))
+    k8sh.k8shConfigPath.cache_clear()
+    yield tmp_path
+    k8sh.k8shConfigPath.cache_clear()
+
+
+def test_config_path(config_dirs):
+    """The xdg path is preferred, the legacy one is only used if it's the only one there"""
+    xdgpath = config_dirs / "config" / "k8shrc.yaml"
+    legacypath = config_dirs / ".k8shrc.yaml"
+    assert k8sh.k8shConfigPath() == xdgpath
+    k8sh.k8shConfigPath.cache_clear()
+    legacypath.touch()
+    with pytest.warns(UserWarning, match="deprecated"):
+        assert k8sh.k8shConfigPath() == legacypath
+    k8sh.k8shConfigPath.cache_clear()
+    xdgpath.parent.mkdir()
+    xdgpath.touch()
+    assert k8sh.k8shConfigPath() == xdgpath
@@ -0,0 +1,126 @@
+import os
+import stat
+import subprocess
+from unittest import mock
+
+import k8sh
+import pytest
+from k8sh import exec as e
+
+
+@pytest.fixture
+def local() -> e.RemoteCommand:
+    """A RemoteCommand running commands on this machine"""
+    return e.RemoteCommand(None)
+
+
+@pytest.fixture
+def fake_kubectl(tmp_path, monkeypatch):
+    """Put a kubectl in the PATH that prints the resource it's asked for, or fails on 'missing'"""
+    script = tmp_path / "kubectl"
+    script.write_text("""#!/bin/sh
+# Called as kubectl -n <namespace> get <resource> -o=json
+if [ "$4" = missing ]; then
+    echo 'Error from server (NotFound): missing' >&2
+    exit 1
+fi
+printf '{"namespace": "%s", "resource": "%s"}' "$2" "$4"
+""")
+    script.chmod(script.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(e.Kubectl, "kubeconfig_fmt", "KUBECONFIG=/dev/null")
+
+
+def test_run_arguments(local):
+    """Arguments get to the command exactly as passed"""
+    args = ["a b", "it's", '"quoted"', "$HOME", "back\\slash", ""]
+    out = local.run(["printf", "%s|"] + args)
+    assert out.returncode == 0
+    assert out.stdout.decode() == "|".join(args) + "|"
+
+
+def test_run_returncode(local):
+    """The return code and stderr are reported"""
+    out = local.run(["sh", "-c", "echo oops >&2; exit 3"])
+    assert out.returncode == 3
+    assert out.stdout == b""
+    assert out.stderr == b"oops\n"
+    assert local.run_sync(["sh", "-c", "exit 4"]) == 4
+
+
+def test_run_large_output(local):
+    """Output larger than the pipe buffers on both streams doesn't block"""
+    out = local.run(["sh", "-c", "head -c 300000 /dev/zero; head -c 200000 /dev/zero >&2; echo done"])
+    assert out.returncode == 0
+    assert len(out.stdout) == 300005
+    assert out.stdout.endswith(b"done\n")
+    assert len(out.stderr) == 200000
+
+
+def test_run_small_reads(local, monkeypatch):
+    """The output is put back together whatever the size of the reads"""
+    monkeypatch.setattr(e.RemoteCommand, "read_size", 3)
+    out = local.run(["printf", "abcdefgh\nij"])
+    assert out.stdout == b"abcdefgh\nij"
+
+
+def test_run_sync_lines(local, monkeypatch, capsys):
+    """Streamed output is printed in whole lines, stderr in red"""
+    monkeypatch.setattr(e.RemoteCommand, "read_size", 3)
+    rc = local.run_sync(["sh", "-c", "printf 'first line\\nsecond'; echo error >&2; printf ' line'"])
+    assert rc == 0
+    out = capsys.readouterr().out.splitlines()
+    # The streams are interleaved in whichever order they got read, but lines are never split.
+    assert sorted(out) == sorted(["first line", "second line", k8sh.red("error")])
+
+
+def test_run_script(local):
+    """A script is interpreted by the shell"""
+    out = local.run_script("for i in 1 2; do echo $i; done; false")
+    assert out.returncode == 1
+    assert out.stdout == b"1\n2\n"
+
+
+def test_json_batch(local, fake_kubectl):
+    """Queries are run in one go, each getting its own output"""
+    kubectls = [e.Kubectl("cluster", ns, local) for ns in ["ns1", "ns2"]]
+    results = e.json_batch([(kubectls[0], "get pods"), (kubectls[1], "get services")])
+    assert results == [
+        {"namespace": "ns1", "resource": "pods"},
+        {"namespace": "ns2", "resource": "services"},
+    ]
+
+
+def test_json_batch_failure(local, fake_kubectl):
+    """A failing query in a batch is reported as such"""
+    kubectl = e.Kubectl("cluster", "ns", local)
+    with pytest.raises(k8sh.k8shError, match=r"get missing -o=json: process returned with retcode: 1.*NotFound"):
+        e.json_batch([(kubectl, "get pods"), (kubectl, "get missing")])
+    # What succeeded is still usable
+    assert kubectl._cached(kubectl._kubectl("get pods -o=json")) == {"namespace": "ns", "resource": "pods"}
+
+
+def test_master_reopen(monkeypatch):
+    """A master connection that went away is opened again"""
+    remote = e.RemoteCommand("example.com", master_path="/tmp/%C")
+    popen = mock.MagicMock()
+    run = mock.MagicMock()
+    monkeypatch.setattr(e.subprocess, "Popen", popen)
+    monkeypatch.setattr(e.subprocess, "run", run)
+    remote.open()
+    assert popen.call_count == 1
+    # Still running
+    popen.return_value.poll.return_value = None
+    remote.open()
+    assert popen.call_count == 1
+    # In the background
+    popen.return_value.poll.return_value = 0
+    run.return_value = subprocess.CompletedProcess([], 0)
+    remote.open()
+    assert popen.call_count == 1
+    assert run.call_args[0][0][-3:] == ["-O", "check", "example.com"]
+    # Gone
+    run.return_value = subprocess.CompletedProcess([], 255)
+    remote.open()
+    assert popen.call_count == 2
+    remote._master = None
@@ -36,7 +36,7 @@ def pod(mockctl) -> k.Pod:
     "status": {
         "containerStatuses": [
             {"name": "container1", "containerID": "docker://123"},
-            {"name": "container2", "containerID": "docker://567"}
+            {"name": "container2", "containerID": "containerd://567"}
         ]
     }
 }
@@ -77,6 +77,8 @@ def test_path_change(hierarchy):
     assert p.cd("../service.service") == (ns, "service.service")
     ns._children = [p, s]
     assert ns.cd("service.service") == (s, "")
+    # Only the leading fragment is consumed
+    assert ns.cd("pod.pod/pod.pod") == (p, "pod.pod")
     # Absolute path
     assert c.cd("/namespace/service.service") == (cl, "namespace/service.service")
 
@@ -86,6 +88,8 @@ def test_match(pod):
     assert pod.match("pod.a*")
     assert pod.match("pod.apod")
     assert not pod.match("service.*")
+    assert not pod.match("pod.a")
+    assert pod.match("pod.[ab]pod")
 
 
 # Pod-specific tests.
@@ -95,6 +99,9 @@ def test_pod_children(pod):
     assert len(containers) == 2
     assert containers[0].name == "container1"
     assert containers[0].ID == "123"
+    assert containers[1].ID == "567"
+    # Containers on the same host share the remote
+    assert containers[0]._remote is containers[1]._remote
     pod.kubectl.remote.run.assert_called_with(
         [
             "KUBECONFIG=/etc/kubernetes/namespace-cluster.config",
@@ -120,8 +127,194 @@ def test_pod_hostname(pod):
     assert pod.hostname == "test"
 
 
+def test_json_cache_size(mockctl):
+    """Only the most recently used namespaces are kept"""
+    mockctl.remote.run.return_value = subprocess.CompletedProcess([], 0, stdout=b"{}")
+    kubectls = [e.Kubectl("cluster", f"ns{i}", mockctl.remote) for i in range(e._json_cache_size + 1)]
+    for kubectl in kubectls:
+        kubectl.json("get pods")
+    kubectls[-1].json("get pods")
+    assert mockctl.remote.run.call_count == len(kubectls)
+    kubectls[0].json("get pods")
+    assert mockctl.remote.run.call_count == len(kubectls) + 1
+
+
+def test_pod_refresh(pod):
+    """Responses are reused until the object is refreshed"""
+    pod.children
+    pod._children = None
+    pod.children
+    pod.kubectl.remote.run.assert_called_once()
+    pod.refresh()
+    pod.children
+    assert pod.kubectl.remote.run.call_count == 2
+
+
+@pytest.mark.parametrize(
+    "master_path,shared",
+    [("/run/user/%i/ssh-%C", True), ("/tmp/%r@%h:%p", True), ("/tmp/k8sh-ctl", False), ("", False)],
+)
+def test_container_remote(master_path, shared):
+    """Containers only share the master path with the kubectl host if ssh makes it per-host"""
+    remote = e.RemoteCommand("kubectl.example.com", ["-4"], master_path)
+    c = k.Container("container", e.Kubectl("cluster", "namespace", remote), None)
+    c.set_remote("worker.example.com")
+    assert c._remote.host == "worker.example.com"
+    assert c._remote.ssh_opts == ["-4"]
+    assert c._remote.master_path == (master_path if shared else "")
+
+
+@pytest.mark.parametrize("container_id,pid", [(":", "1"), ("not-this-container", "456")])
+def test_container_nsenter_stale_pid(tmp_path, container_id, pid):
+    """The cached PID is only used while it belongs to the container"""
+    remote = mock.MagicMock()
+    c = k.Container("container", e.Kubectl("cluster", "namespace", remote), None)
+    c.ID = container_id
+    c._remote = remote
+    # PID 1 is always there, and any line in its cgroup file has a colon.
+    c._pid = "1"
+    remote.run_sync.return_value = 0
+    c.nsenter("-n ip addr")
+    # Run the script locally with stand-ins for docker and nsenter.
+    for name, body in [("docker", "echo 456"), ("nsenter", 'echo "$@"')]:
+        script = tmp_path / name
+        script.write_text(f"#!/bin/sh\n{body}\n")
+        script.chmod(0o755)
+    out = subprocess.run(
+        remote.run_sync.call_args[0][0][1:],
+        capture_output=True,
+        env={"PATH": f"{tmp_path}:/usr/bin:/bin"},
+    )
+    assert out.stdout.decode() == f"-t {pid} -n ip addr\n"
+
+
 # End pod
 
+# Begin namespace
+def test_namespace_children(mockctl):
+    """Pods and services are fetched with a single kubectl call"""
+    mockctl.remote.run.return_value = subprocess.CompletedProcess(
+        ["kubectl", "get", "pods,services"],
+        0,
+        stdout=b"""
+{
+    "kind": "List",
+    "items": [
+        {
+            "kind": "Pod",
+            "metadata": {"name": "apod"},
+            "spec": {"nodeName": "test"},
+            "status": {"containerStatuses": [{"name": "container1", "containerID": "docker://123"}]}
+        },
+        {"kind": "Service", "metadata": {"name": "aservice"}}
+    ]
+}
+""",
+    )
+    ns = k.Namespace("namespace", mockctl, None)
+    assert [c.path_fragment() for c in ns.children] == ["pod.apod", "service.aservice"]
+    mockctl.remote.run.assert_called_once_with(
+        [
+            "KUBECONFIG=/etc/kubernetes/namespace-cluster.config",
+            "kubectl",
+            "-n",
+            "namespace",
+            "get",
+            "pods,services",
+            "-o=json",
+        ]
+    )
+    # The pods don't need to query kubectl again.
+    pod = ns.children[0]
+    assert pod.hostname == "test"
+    assert pod._children is None
+    assert [c.name for c in pod.children] == ["container1"]
+    mockctl.remote.run.assert_called_once()
+
+
+def test_namespace_children_failure(mockctl):
+    mockctl.remote.run.return_value = subprocess.CompletedProcess([], 1, stderr=b"fail")
+    ns = k.Namespace("namespace", mockctl, None)
+    with pytest.raises(k8sh.k8shError):
+        ns.children
+    # The failure isn't mistaken for an empty namespace
+    assert ns._children is None
+
+
+def test_namespace_get_child(mockctl):
+    """A single child is queried directly if we haven't listed the namespace"""
+    mockctl.remote.run.return_value = subprocess.CompletedProcess(
+        [], 0, stdout=b'{"kind": "Pod", "metadata": {"name": "apod"}, "spec": {"nodeName": "test"}}'
+    )
+    ns = k.Namespace("namespace", mockctl, None)
+    pod = ns.get_child("pod.apod")
+    assert pod.name == "apod"
+    assert pod.hostname == "test"
+    assert pod.parent is ns
+    assert ns._children is None
+    mockctl.remote.run.assert_called_once()
+    assert mockctl.remote.run.call_args[0][0][-3:] == ["pods", "apod", "-o=json"]
+    # Asking again gets us the same object, without querying again
+    assert ns.get_child("pod.apod") is pod
+    mockctl.remote.run.assert_called_once()
+    # Objects that don't exist are not an error
+    mockctl.remote.run.return_value = subprocess.CompletedProcess(
+        [], 1, stderr=b'Error from server (NotFound): pods "nope" not found'
+    )
+    assert ns.get_child("pod.nope") is None
+    assert ns.get_child("foo.bar") is None
+    # Anything else is
+    mockctl.remote.run.return_value = subprocess.CompletedProcess([], 1, stderr=b"Forbidden")
+    with pytest.raises(k8sh.k8shError):
+        ns.get_child("service.nope")
+    # Listing the namespace keeps the pod we already had
+    mockctl.remote.run.return_value = subprocess.CompletedProcess(
+        [], 0, stdout=b'{"items": [{"kind": "Pod", "metadata": {"name": "apod"}, "spec": {"nodeName": "test"}}]}'
+    )
+    assert ns.children == [pod]
+    assert ns.children[0] is pod
+
+
+def test_cluster_cd(mockctl):
+    """Only the first fragment of a path is looked up at each level"""
+    mockctl.remote.run.return_value = subprocess.CompletedProcess([], 0, stdout=b'{"metadata": {"name": "ns"}}')
+    cl = k.Cluster("cluster", mockctl)
+    ns, residual = cl.cd("ns/pod.apod/container")
+    assert ns.name == "ns"
+    assert residual == "pod.apod/container"
+    assert mockctl.remote.run.call_args[0][0][-3:] == ["namespaces", "ns", "-o=json"]
+    assert cl.cd("ns/")[0] is ns
+    mockctl.remote.run.assert_called_once()
+
+
+def test_prefetch(mockctl):
+    """Namespaces are listed with a single remote command"""
+    listing = b'{"items": [{"kind": "Service", "metadata": {"name": "aservice"}}]}'
+    mockctl.remote.run_script.return_value = subprocess.CompletedProcess(
+        [], 0, stdout=listing + b"\n---K8SH-RC:0\n" + listing + b"\n---K8SH-RC:0\n"
+    )
+    namespaces = [k.Namespace(name, e.Kubectl("cluster", name, mockctl.remote), None) for name in ["ns1", "ns2"]]
+    k.prefetch(namespaces)
+    for ns in namespaces:
+        assert [c.name for c in ns._children] == ["aservice"]
+    mockctl.remote.run_script.assert_called_once()
+    mockctl.remote.run.assert_not_called()
+    # The responses are cached like any other
+    assert namespaces[0].kubectl.json("get pods,services")["items"][0]["metadata"]["name"] == "aservice"
+    mockctl.remote.run.assert_not_called()
+
+
+def test_prefetch_pods(pod):
+    """Other objects are fetched concurrently"""
+    pods = [pod, k.Pod("bpod", pod.kubectl, None)]
+    k.prefetch(pods)
+    for p in pods:
+        assert [c.name for c in p._children] == ["container1", "container2"]
+    assert pod.kubectl.remote.run.call_count == 2
+
+
+# End namespace
+
 # Begin service
 def test_service_basics(hierarchy):
     s = hierarchy[4]
@@ -142,54 +335,38 @@ def test_service_cd(hierarchy):
 
 def test_service_get(mockctl):
     s = k.Service("service", mockctl, None)
-    # Simplified output of a typical
-    # `kubectl -n $namespace get service $service -o=json`
+    # Output of `kubectl -n $namespace get service $service -o=jsonpath=...`
     mockctl.remote.run.return_value = subprocess.CompletedProcess(
-        ["kubectl", "get", "pods"],
+        ["kubectl", "get", "services"],
         0,
-        stdout=b"""
-{
-  "apiVersion": "v1",
-  "kind": "Service",
-  "metadata": {
-    "labels": {
-      "app": "test"
-    },
-     "name": "service",
-    "namespace": "namespace",
-    "resourceVersion": "7",
-    "selfLink": "/api/v1/namespaces/namespace/services/service",
-    "uid": "test"
-  },
-  "spec": {
-    "clusterIP": "192.168.0.100",
-    "externalTrafficPolicy": "Cluster",
-    "ports": [
-      {
-        "name": "http",
-        "nodePort": 3000,
-        "port": 3030,
-        "protocol": "TCP",
-        "targetPort": 3030
-      }
-    ],
-    "selector": {
-      "app": "test",
-      "release": "release"
-    },
-    "sessionAffinity": "None",
-    "type": "NodePort"
-  },
-  "status": {
-    "loadBalancer": {}
-  }
-}
-""",
+        stdout=b"http\t3030\t3000\nmetrics\tmetrics\t\n",
     )
     assert s.get() == {
         "name": "namespace/services/service",
-        "ports": [{"name": "http", "target": 3030, "nodeport": 3000}],
+        "ports": [
+            {"name": "http", "target": 3030, "nodeport": 3000},
+            {"name": "metrics", "target": "metrics", "nodeport": None},
+        ],
     }
+    mockctl.remote.run.assert_called_with(
+        [
+            "KUBECONFIG=/etc/kubernetes/namespace-cluster.config",
+            "kubectl",
+            "-n",
+            "namespace",
+            "get",
+            "services",
+            "service",
+            '-o=jsonpath={range .spec.ports[*]}{.name}{"\\t"}{.targetPort}{"\\t"}{.nodePort}{"\\n"}{end}',
+        ]
+    )
+
+
+def test_service_get_no_ports(mockctl):
+    """A service without ports has no output"""
+    s = k.Service("service", mockctl, None)
+    mockctl.remote.run.return_value = subprocess.CompletedProcess([], 0, stdout=b"")
+    assert s.get()["ports"] == []
 
 
 def test_service_get_fail(mockctl):
@@ -1,6 +1,7 @@
 import subprocess
+import time
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 from unittest import mock
 
 import cmd2_ext_test
@@ -21,35 +22,64 @@ class K8shTester(cmd2_ext_test.ExternalTestMixin, KubeCmd):
         super().__init__(*args, **kwargs)
 
 
-@pytest.fixture
-def minikube():
-    """Provide a KubeCmd that connects to minikube"""
-    kubeconfig_path = Path.home() / ".kube" / "config"
-    config = ConfigProfiles(
-        Config(kubectl_host=None, kubeconfig_format=f"KUBECONFIG={kubeconfig_path}", ssh_controlmaster_path=""), {}
-    )
-    remote = mock.MagicMock(spec=ex.RemoteCommand)
-    remote.host = config.default.kubectl_host
-    remote.ssh_opts = config.default.ssh_opts
-    ex.Kubectl.kubeconfig_fmt = config.default.kubeconfig_format
-    app = K8shTester(remote, config)
+_KUBECONFIG = Path.home() / ".kube" / "config"
+_CONFIG = Config(kubectl_host=None, kubeconfig_format=f"KUBECONFIG={_KUBECONFIG}", ssh_controlmaster_path="")
+_PROFILES = ConfigProfiles(_CONFIG, {})
+
+
+class _FakeRemote:
+    """Stand-in for RemoteCommand, much cheaper to build than a MagicMock with a spec."""
+
+    def __init__(self, host: Optional[str] = None, ssh_opts: Optional[List] = None):
+        self.host = host
+        self.ssh_opts = ssh_opts
+        self.master_path = ""
+        self.open = mock.MagicMock()
+        self.close = mock.MagicMock()
+        self.run = mock.MagicMock()
+        self.run_sync = mock.MagicMock()
+        self.run_script = mock.MagicMock()
+
+
+@pytest.fixture(scope="module")
+def k8sh_app():
+    """Provide a KubeCmd, initialized once per module as setting up cmd2 is expensive."""
+    app = K8shTester(_FakeRemote(), ConfigProfiles(Config(), {}))
     app.fixture_setup()
     yield app
     app.fixture_teardown()
 
 
+@pytest.fixture
+def minikube(k8sh_app):
+    """Provide a KubeCmd that connects to minikube"""
+    remote = _FakeRemote(_CONFIG.kubectl_host, _CONFIG.ssh_opts)
+    # Not done at import time: other tests, and the "use" command, change it.
+    ex.Kubectl.kubeconfig_fmt = _CONFIG.kubeconfig_format
+    # Reset whatever the previous test left behind in the shared app.
+    k8sh_app.remote = remote
+    k8sh_app.config = _PROFILES
+    k8sh_app.current = kubernetes.KubeObject("null", ex.Kubectl("", "", remote), None)
+    k8sh_app._forget_clusters()
+    k8sh_app._completions = (None, "", 0.0, [])
+    k8sh_app.prompt = k8sh_app._prompt()
+    return k8sh_app
+
+
+_KIND_CLS = {
+    "cluster": kubernetes.Cluster,
+    "namespace": kubernetes.Namespace,
+    "pod": kubernetes.Pod,
+    "container": kubernetes.Container,
+}
+
+
 def _getobj(kind: str, name: str, parent: Optional[kubernetes.KubeObject] = None):
-    cls = {
-        "cluster": kubernetes.Cluster,
-        "namespace": kubernetes.Namespace,
-        "pod": kubernetes.Pod,
-        "container": kubernetes.Container,
-    }
-    kubectl = ex.Kubectl("minikube", "default", mock.MagicMock(spec=ex.RemoteCommand))
+    kubectl = ex.Kubectl("minikube", "default", _FakeRemote())
     if parent is not None:
-        obj = cls[kind](name, kubectl, parent)
+        obj = _KIND_CLS[kind](name, kubectl, parent)
     else:
-        obj = cls[kind](name, kubectl)
+        obj = _KIND_CLS[kind](name, kubectl)
     obj._children = []
     if parent is not None:
         parent._children.append(obj)
@@ -85,6 +115,12 @@ def test_use(minikube):
     assert isinstance(minikube.current, kubernetes.Cluster)
     assert minikube.current.name == "minikube"
     assert "minikube" in minikube.prompt
+    # Using the same cluster again gets us back to the same cluster, with what's in it fetched again
+    cluster = minikube.current
+    cluster._children = []
+    minikube.app_cmd("use minikube")
+    assert minikube.current is cluster
+    assert cluster._children is None
 
 
 def test_cd(objtree):
@@ -95,6 +131,14 @@ def test_cd(objtree):
     assert objtree.current.kind == "namespace"
     assert objtree.current.name == "default"
     assert "/default" in objtree.prompt
+    # The prompt is only rendered again when we move
+    with mock.patch.object(objtree, "_render_prompt") as render:
+        objtree.app_cmd("ls")
+        render.assert_not_called()
+        # Nor when we go back somewhere we've been
+        objtree.app_cmd("cd /")
+        objtree.app_cmd("cd default")
+        render.assert_not_called()
     # Relative cd
     out = objtree.app_cmd("cd ../kube-system/pod.coredns/prom-dns-exporter")
     assert objtree.current.name == "prom-dns-exporter"
@@ -105,6 +149,12 @@ def test_cd(objtree):
     # cd without arguments brings us back to the cluster level
     objtree.app_cmd("cd")
     assert objtree.current.kind == "cluster"
+    # Landing on an object listed a while ago fetches its children again
+    namespace = objtree.current.get_child("default")
+    namespace._listed_at = time.monotonic() - ex.Kubectl.cache_ttl - 1
+    objtree.app_cmd("cd default")
+    assert objtree.current is namespace
+    assert namespace._children is None
 
 
 @pytest.mark.parametrize(
@@ -113,8 +163,10 @@ def test_cd(objtree):
         ("", "default\nkube-system"),
         ("test", ""),
         ("default/pod.f*", "default/pod.failoid"),
+        ("kube-system/pod.coredns", "kube-system/pod.coredns"),
         ("default/../kube-system/*etcd/*", "kube-system/pod.coretcd/etcd\nkube-system/pod.coretcd/nginx"),
         ("default/..", "/"),
+        ("*/..", "/"),
         ("default/../", "default\nkube-system"),
     ],
 )
@@ -126,23 +178,27 @@ def test_ls(arg, expected, objtree):
 
 def test_switch_profile(minikube):
     """Test that switching profile will switch the remote object if needed."""
-    minikube.config.get = mock.MagicMock(return_value=Config(kubectl_host="test"))
     mocker = minikube.remote
-    with mock.patch("k8sh.shell.RemoteCommand.open") as canopener:
+    # The configuration is shared between tests, don't leave the mock behind.
+    with mock.patch.object(minikube.config, "get", return_value=Config(kubectl_host="test")), mock.patch(
+        "k8sh.shell.RemoteCommand.open"
+    ) as canopener:
         minikube.app_cmd("use test")
         # The original remote has no kubectl_host, we're now passing a configuration containing a remote host
         mocker.close.assert_called_with()
         # The new one has been "opened"
         canopener.assert_called_with()
+    # Clusters seen through the old remote are forgotten
+    assert list(minikube._clusters) == ["test"]
 
 
-def test_cmd_before_use(minikube):
+@pytest.mark.parametrize("cmd", ["exec ls /", "view", "tail", "cd /test", "ls"])
+def test_cmd_before_use(cmd, minikube):
     """Test that if we invoke any command before 'use' a warning message will be emitted."""
     minikube.app_cmd("set debug true")
-    for cmd in ["exec ls /", "view", "tail", "cd /test", "ls"]:
-        out = minikube.app_cmd(cmd)
-        assert out.stderr == ""
-        assert out.stdout.rstrip() == red("Please select a cluster with 'use' first")
+    out = minikube.app_cmd(cmd)
+    assert out.stderr == ""
+    assert out.stdout.rstrip() == red("Please select a cluster with 'use' first")
 
 
 def test_exec_bad_context(objtree):
@@ -165,15 +221,30 @@ def test_complete_cd(objtree):
     assert ["pod.failoid"] == objtree.complete_cd("pod.f", 0, 0, 0)
     # Case 5: non-existent completion
     assert [] == objtree.complete_cd("pink", 0, 0, 0)
+    # Repeated completions reuse the listing
+    with mock.patch.object(kubernetes.Namespace, "children", new_callable=mock.PropertyMock) as children:
+        assert ["pod.pinkunicorn"] == objtree.complete_cd("pod.p", 0, 0, 0)
+        children.assert_not_called()
 
 
-def test_ls_max_queries(objtree):
+def test_ls_max_queries(objtree, monkeypatch):
     """Test ls query protections"""
-    orig_q_length = shell.MAX_QUERY_LENGTH
-    shell.MAX_QUERY_LENGTH = 1
+    monkeypatch.setattr(shell, "MAX_QUERY_LENGTH", 1)
     arg = Statement("*/pod.*", "ls */pod.*", "ls")
     assert objtree.ls(arg) == []
-    shell.MAX_QUERY_LENGTH = orig_q_length
+    # Paths without globs are too, if they look into many objects
+    arg = Statement("/pod.failoid", "ls /pod.failoid", "ls")
+    assert objtree.ls(arg) == []
+    # But not if they just go down a single path
+    arg = Statement("default/pod.failoid/http", "ls default/pod.failoid/http", "ls")
+    assert [obj.name for obj in objtree.ls(arg)] == ["http"]
+
+
+def test_ls_no_glob_is_fast(objtree):
+    """Test ls looks up paths without globs directly, without matching."""
+    with mock.patch.object(kubernetes, "compile_match", side_effect=AssertionError("glob matching used")):
+        out = objtree.app_cmd("ls default/pod.failoid/http")
+    assert out.stdout.rstrip() == "default/pod.failoid/http"
 
 
 def test_ps(objtree):
@@ -218,15 +289,26 @@ def test_nsenter(objtree):
     # The first to get the PID of the container,
     # the second to execute nsenter.
     objtree.current.kubectl.remote.run.return_value = subprocess.CompletedProcess("test", 0, b"456")
-    objtree.current.kubectl.remote.run_sync.return_value = subprocess.CompletedProcess("test", 0, b"test output")
+    objtree.current.kubectl.remote.run_sync.return_value = 0
     # This also verifies the pipe is interpreted by cmd2
     objtree.app_cmd("nsenter -n telnet localhost 25 | grep pinkunicorn")
     objtree.current.kubectl.remote.run.assert_called_with(
-        ["sudo", "docker", "inspect", "-f", "'{{.State.Pid}}'", 123],
-    )
-    objtree.current.kubectl.remote.run_sync.assert_called_with(
-        ["sudo", "nsenter", "-t", "456", "-n", "telnet", "localhost", "25"],
+        ["sudo", "docker", "inspect", "-f", "{{.State.Pid}}", 123],
     )
+    cmd = objtree.current.kubectl.remote.run_sync.call_args[0][0]
+    assert cmd[:3] == ["sudo", "sh", "-c"]
+    assert cmd[3].startswith("pid=456; ")
+    assert cmd[3].endswith('nsenter -t "$pid" -n telnet localhost 25')
+    # The PID is remembered for the next time
+    objtree.app_cmd("nsenter -n ss -tlnp")
+    objtree.current.kubectl.remote.run.assert_called_once()
+    cmd = objtree.current.kubectl.remote.run_sync.call_args[0][0]
+    assert cmd[3].startswith("pid=456; ")
+    assert cmd[3].endswith('nsenter -t "$pid" -n ss -tlnp')
+    # Unless the container is refreshed
+    objtree.current.refresh()
+    objtree.app_cmd("nsenter -n ss -tlnp")
+    assert objtree.current.kubectl.remote.run.call_count == 2
 
 
 def test_exec(objtree):
@@ -259,27 +341,48 @@ def test_eventlog(objtree):
     """Test fetching the eventlog"""
     # Test 1: in a namespace context we only get events for that ns
     objtree.app_cmd("cd default")
-    objtree.current.kubectl.run_sync = mock.MagicMock(return_value=subprocess.CompletedProcess("test", 0))
-    objtree.app_cmd("eventlog")
-    objtree.current.kubectl.run_sync.assert_called_with("get events --sortBy='.metadata.creationTimestamp'")
+    with mock.patch.object(ex.Kubectl, "run_sync", autospec=True, return_value=0) as mocker:
+        objtree.app_cmd("eventlog")
+        mocker.assert_called_with(objtree.current.kubectl, "get events --sortBy='.metadata.creationTimestamp'")
     # Test 2: in cluster context, the call should add -A and be an admin call.
     objtree.app_cmd("cd ..")
     assert objtree.current.kind == "cluster"
-    objtree.current.kubectl.run_sync = mock.MagicMock(return_value=subprocess.CompletedProcess("test", 0))
-    objtree.app_cmd("eventlog")
-    objtree.current.kubectl.run_sync.assert_called_with("get events --sortBy='.metadata.creationTimestamp' -A", True)
+    with mock.patch.object(ex.Kubectl, "run_sync", autospec=True, return_value=0) as mocker:
+        objtree.app_cmd("eventlog")
+        mocker.assert_called_with(objtree.current.kubectl.admin, "get events --sortBy='.metadata.creationTimestamp' -A")
 
 
 def test_delete(objtree):
     """Test deleting a pod."""
-    mocker = mock.MagicMock(return_value=subprocess.CompletedProcess("test", 0))
     objtree.app_cmd("cd default/pod.failoid")
-    objtree.current.kubectl.run = mocker
+    kubectl = objtree.current.kubectl
     objtree.app_cmd("cd ..")
-    objtree.app_cmd("rm pod.failoid")
-    mocker.assert_called_with("delete pod failoid", True)
+    result = subprocess.CompletedProcess("test", 0)
+    with mock.patch.object(ex.Kubectl, "run", autospec=True, return_value=result) as mocker:
+        objtree.app_cmd("rm pod.failoid")
+        # The removal is an admin call
+        mocker.assert_called_with(kubectl.admin, "delete pod failoid")
     # verify the pod isn't in the output of ls anymore
     out = objtree.app_cmd("ls")
     assert "pod.failoid" not in out.stdout
+    # Nothing removed, nothing to fetch again
+    objtree.current._children = children = []
     output = objtree.app_cmd("rm pod.nothere")
     assert "pod.nothere: no such object" in output.stdout
+    assert objtree.current._children is children
+
+
+def test_delete_overlapping(objtree):
+    """Objects matched by more than one argument are deleted once."""
+    objtree.app_cmd("cd default")
+    result = subprocess.CompletedProcess("test", 0)
+    with mock.patch.object(ex.Kubectl, "run", autospec=True, return_value=result) as mocker:
+        out = objtree.app_cmd("rm pod.failoid pod.f* pod.*")
+        mocker.assert_has_calls(
+            [
+                mock.call(mock.ANY, "delete pod failoid"),
+                mock.call(mock.ANY, "delete pod pinkunicorn"),
+            ]
+        )
+        assert mocker.call_count == 2
+    assert out.stdout.count("removed") == 2